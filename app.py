@@ -1,28 +1,76 @@
-import os, json
+import os
+import sys
+import shutil
+import threading
+import uuid
+import orjson
 from datetime import datetime, timedelta, date
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, send_from_directory, make_response
+from flask.helpers import get_debug_flag
 from flask_sqlalchemy import SQLAlchemy
 from flask_apscheduler import APScheduler
+from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from jinja2 import FileSystemBytecodeCache
 from werkzeug.utils import secure_filename
-from sqlalchemy import func
+from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.exceptions import NotFound
+from werkzeug.serving import is_running_from_reloader
+from sqlalchemy import func, text, bindparam, event, cast, update, insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import joinedload, selectinload
 
 app = Flask(__name__)
 app.secret_key = "secret_key_inventory"
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
+# 連線可在請求執行緒與排程器執行緒間共用；遇到寫入鎖時最多等 30 秒，而不是立刻丟出 database is locked
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_pre_ping': True,
+    'connect_args': {'check_same_thread': False, 'timeout': 30}
+}
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
+app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 上傳上限 16MB，超過直接回 413
 app.config['RECORDS_FOLDER'] = 'static/records'
+app.config['RENDERED_FOLDER'] = 'static/records/rendered'  # 日報表預先渲染好的 HTML (子資料夾，不會出現在歷史清單)
+app.config['JINJA_CACHE_FOLDER'] = '.jinja_cache'
+# 部署在支援 X-Sendfile 的前端伺服器 (Apache mod_xsendfile、lighttpd) 後面時設 USE_X_SENDFILE=1，報表檔由伺服器直接送出
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+# 模板編譯結果寫入磁碟快取，且不再每次請求檢查模板檔是否變動
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+app.jinja_env.auto_reload = False
+# 排程工作存進資料庫 (與主資料庫同一個檔案)，單執行緒依序執行
+app.config['SCHEDULER_JOBSTORES'] = {'default': SQLAlchemyJobStore(url='sqlite:///' + os.path.join(app.instance_path, 'database.db'))}
+app.config['SCHEDULER_EXECUTORS'] = {'default': {'type': 'threadpool', 'max_workers': 1}}
+# 固定排程：工作函式一律用 'app:...' 文字參照存進工作庫，python app.py 與 gunicorn 啟動時都能還原
+app.config['SCHEDULER_JOBS'] = [
+    {'id': 'daily_job', 'func': 'app:auto_save_daily_report', 'trigger': 'cron', 'day': '*', 'hour': '0', 'minute': '0', 'replace_existing': True},
+    {'id': 'monthly_job', 'func': 'app:auto_save_monthly_report', 'trigger': 'cron', 'day': '1', 'hour': '0', 'minute': '10', 'replace_existing': True}
+]
 
 db = SQLAlchemy(app)
 scheduler = APScheduler()
 
-for folder in [app.config['UPLOAD_FOLDER'], app.config['RECORDS_FOLDER']]:
-    if not os.path.exists(folder): os.makedirs(folder)
+# SQLite 連線設定：WAL 讓報表讀取不會被 /sell、/add_product 的寫入卡住，並加大頁面快取
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragma(dbapi_conn, connection_record):
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+for folder in [app.config['UPLOAD_FOLDER'], app.config['RECORDS_FOLDER'], app.config['RENDERED_FOLDER'], app.config['JINJA_CACHE_FOLDER']]:
+    os.makedirs(folder, exist_ok=True)
+
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_CACHE_FOLDER'])
 
 # --- Models (保持不變) ---
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False)
-    products = db.relationship('Product', backref='category', lazy=True)
+    products = db.relationship('Product', back_populates='category', lazy=True)
 
 class Product(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -33,7 +81,9 @@ class Product(db.Model):
     stock = db.Column(db.Integer, default=0)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
     is_deleted = db.Column(db.Boolean, default=False)
+    category = db.relationship('Category', back_populates='products')
     sales = db.relationship('Sale', backref='product', lazy=True)
+    __table_args__ = (db.Index('ix_product_isdeleted', 'is_deleted'),)
 
 class Sale(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -41,98 +91,159 @@ class Sale(db.Model):
     quantity = db.Column(db.Integer, nullable=False)
     profit = db.Column(db.Float, nullable=False)
     revenue = db.Column(db.Float, default=0.0)
-    timestamp = db.Column(db.DateTime, default=datetime.now)
+    # 由 SQLite 在寫入時蓋上本地時間，格式與 SQLAlchemy 存 DateTime 的格式一致 (含微秒)
+    timestamp = db.Column(db.DateTime, nullable=False, server_default=text("(strftime('%Y-%m-%d %H:%M:%f000', 'now', 'localtime'))"))
+    # 報表查詢都是「時間區間 + 依商品分組」，複合索引讓 SQLite 直接定位該區間 (也涵蓋單純的 timestamp 範圍查詢)
+    # (product_id, timestamp) 則給依商品查銷售的路徑，例如 delete_product 的銷售筆數檢查
+    __table_args__ = (
+        db.Index('ix_sale_ts_prod', 'timestamp', 'product_id'),
+        db.Index('ix_sale_product_ts', 'product_id', 'timestamp'),
+    )
+
+# 每日 × 商品銷售彙總：sell() 寫入時同步累加，/reports 圖表與月報表只需讀這張小表 (筆數 = 天數 × 商品數，與銷售筆數無關)
+class DailyRollup(db.Model):
+    date = db.Column(db.Date, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    qty = db.Column(db.Integer, nullable=False, default=0)
+    profit = db.Column(db.Float, nullable=False, default=0.0)
+    revenue = db.Column(db.Float, nullable=False, default=0.0)
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(50), unique=True, nullable=False)
-    password = db.Column(db.String(50), nullable=False)
+    username = db.Column(db.String(50), unique=True, nullable=False)  # unique 已自帶索引
+    password = db.Column(db.String(255), nullable=False)  # 存 werkzeug 雜湊值，不存明碼
+
+PASSWORD_HASH_PREFIXES = ('scrypt:', 'pbkdf2:')
 
 # --- 報表生成邏輯 (兩部分: 日報表Json 與 月報表Html) ---
 
 # 1. 每日 JSON 報表 (保持不變)
+# 日報表寫完 JSON 後順便渲染成 HTML，檢視時直接送靜態檔，不必每次解析 JSON + 渲染模板
+report_detail_template = app.jinja_env.get_template('report_detail.html')
+
+# 報表先寫到同資料夾的暫存檔再 os.replace；檔名加上隨機字串，多個行程同時產生同一份報表時不會寫進同一個暫存檔
+def unique_tmp_path(path):
+    return f"{path}.{uuid.uuid4().hex}.tmp"
+
 def generate_json_report(target_date):
+    # 半開區間 [當天 00:00, 隔天 00:00)，仍可直接走 timestamp 索引
     start_of_day = datetime.combine(target_date, datetime.min.time())
-    end_of_day = datetime.combine(target_date, datetime.max.time())
-    sales_today = Sale.query.filter(Sale.timestamp >= start_of_day, Sale.timestamp <= end_of_day).all()
-    
+    start_of_next_day = start_of_day + timedelta(days=1)
+    in_day = (Sale.timestamp >= start_of_day, Sale.timestamp < start_of_next_day)
+    revenue_col = func.coalesce(Sale.revenue, 0)
+
+    # 統計交給 SQLite 的 GROUP BY 處理，Python 只接收彙總後的幾列
     hourly_data = [0] * 24
-    for s in sales_today: hourly_data[s.timestamp.hour] += s.quantity
-    
-    detail_list = []
-    item_summary = {}
-    total_profit = 0
-    total_revenue = 0
-    
-    for s in sales_today:
-        rev = s.revenue if s.revenue is not None else 0
-        detail_list.append({
-            "time": s.timestamp.strftime("%H:%M:%S"),
-            "product": s.product.name,
-            "qty": s.quantity,
-            "profit": round(s.profit, 2),
-            "revenue": round(rev, 2)
-        })
-        total_profit += s.profit
-        total_revenue += rev
-        if s.product.name not in item_summary: item_summary[s.product.name] = {"qty": 0, "profit": 0, "revenue": 0}
-        item_summary[s.product.name]["qty"] += s.quantity
-        item_summary[s.product.name]["profit"] += s.profit
-        item_summary[s.product.name]["revenue"] += rev
-
-    report_data = {
-        "date": target_date.strftime("%Y-%m-%d"),
+    hourly_rows = db.session.query(
+        cast(func.strftime('%H', Sale.timestamp), db.Integer).label('h'),
+        func.sum(Sale.quantity)
+    ).filter(*in_day).group_by('h').all()
+    for h, qty in hourly_rows: hourly_data[h] = int(qty or 0)
+
+    item_rows = db.session.query(
+        Product.name,
+        func.sum(Sale.quantity),
+        func.sum(Sale.profit),
+        func.sum(revenue_col)
+    ).join(Sale).filter(*in_day).group_by(Product.name).all()
+    item_summary = {name: {"qty": int(qty or 0), "profit": profit or 0, "revenue": rev or 0} for name, qty, profit, rev in item_rows}
+
+    total_profit, total_revenue = db.session.query(func.sum(Sale.profit), func.sum(revenue_col)).filter(*in_day).one()
+    total_profit = total_profit or 0
+    total_revenue = total_revenue or 0
+
+    report_head = {
+        "date": target_date.isoformat(),
         "summary": {"total_profit": round(total_profit, 2), "total_revenue": round(total_revenue, 2), "total_sales_count": sum(hourly_data)},
         "hourly_chart": hourly_data,
-        "item_summary": item_summary,
-        "raw_sales": detail_list
+        "item_summary": item_summary
     }
+
+    # 只有流水帳需要逐筆資料；只取需要的欄位並分批讀取，不建立整批 Sale ORM 物件
+    sales_today = db.session.query(
+        Sale.timestamp, Sale.quantity, Sale.profit, Sale.revenue, Product.name
+    ).join(Product).filter(*in_day).yield_per(1000)
     
-    filename = f"daily_{target_date.strftime('%Y%m%d')}.json"
-    with open(os.path.join(app.config['RECORDS_FOLDER'], filename), 'w', encoding='utf-8') as f:
-        json.dump(report_data, f, ensure_ascii=False, indent=4)
+    filename = f"daily_{target_date.year}{target_date.month:02d}{target_date.day:02d}.json"
+    path = os.path.join(app.config['RECORDS_FOLDER'], filename)
+    # raw_sales 邊讀邊寫入檔案，記憶體裡不會有整天的流水帳列表；先寫暫存檔，完成後再替換，不會讀到寫一半的報表
+    tmp_path = unique_tmp_path(path)
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps(report_head)[:-1])
+        f.write(b',"raw_sales":[')
+        separator = b'\n'
+        for ts, qty, profit, rev, name in sales_today:
+            f.write(separator)
+            f.write(orjson.dumps({
+                "time": f"{ts.hour:02d}:{ts.minute:02d}:{ts.second:02d}",  # 純整數格式化，比逐筆 strftime 快
+                "product": name,
+                "qty": qty,
+                "profit": round(profit, 2),
+                "revenue": round(rev or 0, 2)
+            }))
+            separator = b',\n'
+        f.write(b'\n]}\n')
+    os.replace(tmp_path, path)
+
+    # 摘要沿用記憶體裡的 report_head，流水帳從剛寫好的檔案逐行讀回，模板 stream 邊讀邊寫，不會把整天的銷售載入記憶體
+    rendered_path = os.path.join(app.config['RENDERED_FOLDER'], filename[:-len('.json')] + '.html')
+    rendered_tmp_path = unique_tmp_path(rendered_path)
+    report_detail_template.stream(data=dict(report_head, raw_sales=iter_raw_sales(path))).dump(rendered_tmp_path, encoding='utf-8')
+    os.replace(rendered_tmp_path, rendered_path)
     return filename
 
+# generate_json_report 寫出的流水帳一筆一行 (第一行是摘要，最後一行是 "]}")，可以不解析整份檔案逐筆讀回
+def iter_raw_sales(path):
+    with open(path, 'rb') as f:
+        next(f)
+        for line in f:
+            line = line.rstrip(b',\r\n')
+            if line == b']}': break
+            yield orjson.loads(line)
+
 # 2. [新] 每月 HTML 報表
 # app.py 裡的 generate_monthly_html_report 函式
 
+# 月報表模板在載入時就先解析好 (搭配 bytecode 快取)，排程產生報表時直接 render，不再走模板查找
+# 這個模板只用到傳入的變數，不需要 Flask 的 request / session 等 context
+monthly_template = app.jinja_env.get_template('monthly_template.html')
+
 def generate_monthly_html_report(year, month):
-    # 1. 計算該月的起始與結束時間
-    start_date = datetime(year, month, 1)
+    # 1. 計算該月的起始與「下個月1號」(半開區間)
+    start_date = date(year, month, 1)
     if month == 12:
-        end_date = datetime(year + 1, 1, 1) - timedelta(seconds=1)
+        end_date = date(year + 1, 1, 1)
     else:
-        end_date = datetime(year, month + 1, 1) - timedelta(seconds=1)
+        end_date = date(year, month + 1, 1)
 
-    # 2. 查詢該月所有銷售
-    sales = Sale.query.filter(Sale.timestamp >= start_date, Sale.timestamp <= end_date).all()
+    # 2. 該月各商品的銷售統計直接從 daily_rollup 加總，不必掃 sale 表
+    product_stats = db.session.query(
+        Product.name,
+        func.sum(DailyRollup.profit).label('total_profit'),
+        func.sum(DailyRollup.qty).label('total_qty'),
+        func.sum(DailyRollup.revenue).label('total_revenue')
+    ).join(DailyRollup).filter(DailyRollup.date >= start_date, DailyRollup.date < end_date).group_by(Product.name).all()
     
-    # 3. 統計數據
+    # 3. 整月總計 + 準備給圖表的數據 (圖表還是需要純數字，所以這裡保持 float/int)，一次走訪完成
     total_profit = 0
     total_revenue = 0
     total_qty = 0
-    product_stats = {} 
-
-    for s in sales:
-        rev = s.revenue if s.revenue is not None else 0
-        total_profit += s.profit
-        total_revenue += rev
-        total_qty += s.quantity
-        
-        if s.product.name not in product_stats:
-            product_stats[s.product.name] = {"profit": 0, "qty": 0}
-        product_stats[s.product.name]["profit"] += s.profit
-        product_stats[s.product.name]["qty"] += s.quantity
-        
-    # 準備給圖表的數據 (圖表還是需要純數字，所以這裡保持 float/int)
-    labels = list(product_stats.keys())
-    profit_data = [round(v["profit"], 2) for v in product_stats.values()]
-    qty_data = [v["qty"] for v in product_stats.values()]
+    labels = []
+    profit_data = []
+    qty_data = []
+    for name, profit, qty, rev in product_stats:
+        profit = profit or 0
+        qty = int(qty or 0)
+        total_profit += profit
+        total_revenue += rev or 0
+        total_qty += qty
+        labels.append(name)
+        profit_data.append(round(profit, 2))
+        qty_data.append(qty)
 
     # 4. 渲染 HTML
     # [修改重點] 這裡我們把數字轉成漂亮的字串格式再傳進去
-    html_content = render_template(
-        'monthly_template.html',
+    html_content = monthly_template.render(
         year=year,
         month=month,
         generated_at=datetime.now().strftime('%Y-%m-%d %H:%M'),
@@ -150,21 +261,39 @@ def generate_monthly_html_report(year, month):
     filename = f"monthly_{year}_{month:02d}.html"
     filepath = os.path.join(app.config['RECORDS_FOLDER'], filename)
     
-    with open(filepath, 'w', encoding='utf-8') as f:
+    # 先寫暫存檔再替換，背景產生時使用者不會開到寫一半的檔案
+    tmp_path = unique_tmp_path(filepath)
+    with open(tmp_path, 'w', encoding='utf-8') as f:
         f.write(html_content)
+    os.replace(tmp_path, filepath)
         
     return filename
 
+# 3. 歷史報表清單：資料夾 mtime 沒變就沿用上次排序好的結果，有新檔案才重新掃描
+_history_cache = {'mtime': None, 'files': []}
+_history_lock = threading.Lock()
+
+def list_history_files():
+    folder = app.config['RECORDS_FOLDER']
+    try:
+        mtime = os.stat(folder).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    with _history_lock:
+        if _history_cache['mtime'] != mtime:
+            with os.scandir(folder) as entries:
+                _history_cache['files'] = sorted((entry.name for entry in entries if entry.is_file() and not entry.name.endswith('.tmp')), reverse=True)
+            _history_cache['mtime'] = mtime
+        return _history_cache['files']
+
 # --- 排程任務 ---
 
-# 任務1: 每天存日報表
-@scheduler.task('cron', id='daily_job', day='*', hour='0', minute='0')
+# 任務1: 每天存日報表 (排程設定見 SCHEDULER_JOBS)
 def auto_save_daily_report():
     with app.app_context():
         generate_json_report(date.today() - timedelta(days=1))
 
 # 任務2: 每月1號存月報表 (HTML)
-@scheduler.task('cron', id='monthly_job', day='1', hour='0', minute='10')
 def auto_save_monthly_report():
     with app.app_context():
         # 取得「上個月」的年月份
@@ -175,12 +304,112 @@ def auto_save_monthly_report():
         generate_monthly_html_report(last_month_date.year, last_month_date.month)
         print(f"Monthly report for {last_month_date.strftime('%Y-%m')} generated.")
 
+# 取得 instance 資料夾裡的檔案鎖；blocking=False 時鎖已被別的行程占用就回傳 None
+def acquire_file_lock(name, blocking=True):
+    os.makedirs(app.instance_path, exist_ok=True)
+    lock_file = open(os.path.join(app.instance_path, name), 'a+')
+    try:
+        if os.name == 'nt':
+            import msvcrt
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+# 多個 worker 同時啟動時，只有搶到檔案鎖的那一個會啟動排程器，報表不會重複產生
+# 必須在 app 模組匯入完成後才呼叫 (__main__ 與 gunicorn.conf.py 的 post_worker_init)：
+# 排程執行緒要 import 'app:...' 取得工作函式，模組還在匯入中就啟動會與 add_job 互相等待而卡死
+_scheduler_lock = None
+
+def start_scheduler():
+    global _scheduler_lock
+    # 除錯模式下 reloader 的父行程只負責監看檔案 (flask_apscheduler 也不會在這裡啟動)，鎖留給實際服務請求的子行程
+    if get_debug_flag() and not is_running_from_reloader(): return False
+    lock_file = acquire_file_lock('scheduler.lock', blocking=False)
+    if lock_file is None: return False
+    _scheduler_lock = lock_file  # 保留檔案物件，鎖會持續到行程結束
+    scheduler.init_app(app)
+    # 漏掉的日報表在啟動前排入：排程器尚未啟動時 add_job 只放進待辦清單，start() 時一次寫入工作庫
+    with app.app_context():
+        missing = catch_up_daily_reports()
+    scheduler.start()
+    if missing: print(f"Queued {missing} missing daily report(s).")
+    return True
+
+# 任務3: 月報表改由排程器的執行緒產生，請求不必等 SQL + 模板渲染 + 寫檔
+def run_monthly_report_job(year, month):
+    with app.app_context():
+        generate_monthly_html_report(year, month)
+
+def monthly_report_job_id(year, month):
+    return f"monthly_report_{year}_{month:02d}"
+
+# 回傳 True 代表已排入背景產生；此行程沒有執行排程器時 (未取得排程鎖) 就直接同步產生
+def queue_monthly_report(year, month):
+    if not scheduler.running:
+        generate_monthly_html_report(year, month)
+        return False
+    # 執行緒正忙 (夜間排程、補做日報表) 時會排隊等，不設錯過時限，已告知「產生中」的報表一定會產生
+    scheduler.add_job(
+        id=monthly_report_job_id(year, month),
+        func='app:run_monthly_report_job',
+        args=[year, month],
+        trigger='date',
+        run_date=datetime.now(),
+        misfire_grace_time=None,
+        coalesce=True,
+        replace_existing=True
+    )
+    return True
+
+# 任務4: 啟動時補做關機期間漏掉的日報表 (從第一筆銷售那天到昨天，沒有檔案的日子)
+def run_daily_report_job(target_date):
+    with app.app_context():
+        generate_json_report(target_date)
+
+def catch_up_daily_reports():
+    first_sale = db.session.query(func.min(Sale.timestamp)).scalar()
+    if first_sale is None: return 0
+    existing = set(list_history_files())
+    yesterday = date.today() - timedelta(days=1)
+    day = first_sale.date()
+    now = datetime.now()
+    queued = 0
+    while day <= yesterday:
+        if f"daily_{day.year}{day.month:02d}{day.day:02d}.json" not in existing:
+            # 排入排程器的單一執行緒依序產生；前一份還在跑時後面的會排隊等，不設錯過時限，不會被當成 misfire 丟掉
+            scheduler.add_job(
+                id=f"daily_report_{day.year}{day.month:02d}{day.day:02d}",
+                func='app:run_daily_report_job',
+                args=[day],
+                trigger='date',
+                run_date=now,
+                misfire_grace_time=None,
+                coalesce=True,
+                replace_existing=True
+            )
+            queued += 1
+        day += timedelta(days=1)
+    return queued
+
 # --- 路由 ---
+# 統一的登入檢查：除了登入頁與靜態檔，所有路由都需要先登入
+PUBLIC_ENDPOINTS = {'login', 'static'}
+
+@app.before_request
+def require_login():
+    if request.endpoint not in PUBLIC_ENDPOINTS and not session.get('logged_in'):
+        return redirect(url_for('login'))
+
 # (dashboard, add_product, sell... 保持不變)
 @app.route('/')
 def dashboard():
-    if not session.get('logged_in'): return redirect(url_for('login'))
-    categories = Category.query.all()
+    # selectinload：所有分類的商品用一次 IN (...) 查回，模板迴圈不再逐分類查詢
+    categories = Category.query.options(selectinload(Category.products)).all()
     return render_template('dashboard.html', categories=categories)
 
 @app.route('/api/add_category', methods=['POST'])
@@ -194,6 +423,19 @@ def api_add_category():
     db.session.commit()
     return jsonify({'success': True, 'id': new_cat.id, 'name': new_cat.name})
 
+# 上傳圖片以 1MB 為單位串流寫入暫存檔，寫完再一次替換成正式檔名，不會送出寫一半的圖片
+def save_upload(file, filename):
+    folder = app.config['UPLOAD_FOLDER']
+    tmp_path = os.path.join(folder, f".tmp-{uuid.uuid4().hex}")
+    file.stream.seek(0)
+    try:
+        with open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(file.stream, dst, length=1024 * 1024)
+        os.replace(tmp_path, os.path.join(folder, filename))
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+
 @app.route('/add_product', methods=['POST'])
 def add_product():
     # ... (保持原有的 add_product 代碼) ...
@@ -204,6 +446,8 @@ def add_product():
     price_input = request.form.get('price')
     category_id = request.form.get('category_id')
     file = request.files.get('image')
+    # 上傳檔名只做一次 secure_filename，沒有選檔案時為空字串
+    image_name = secure_filename(file.filename) if file and file.filename else ''
 
     existing_prod = Product.query.filter_by(name=name).first()
 
@@ -215,10 +459,9 @@ def add_product():
         if cost_input: existing_prod.cost = float(cost_input)
         if price_input: existing_prod.price = float(price_input)
         if category_id: existing_prod.category_id = int(category_id)
-        if file and file.filename != '':
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            existing_prod.image = filename
+        if image_name:
+            save_upload(file, image_name)
+            existing_prod.image = image_name
         db.session.commit()
         if not existing_prod.is_deleted:
             flash(f"商品「{name}」已進貨，庫存增加：{new_stock}")
@@ -226,9 +469,9 @@ def add_product():
         if not cost_input or not price_input:
             flash("錯誤：新商品必須輸入成本與售價！")
             return redirect(url_for('dashboard'))
-        filename = secure_filename(file.filename) if file and file.filename != '' else "default.jpg"
-        if file and file.filename != '':
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+        if image_name:
+            save_upload(file, image_name)
+        filename = image_name or "default.jpg"
         cat_id = int(category_id) if category_id else 1
         new_prod = Product(name=name, cost=float(cost_input), price=float(price_input), image=filename, stock=new_stock, category_id=cat_id, is_deleted=False)
         db.session.add(new_prod)
@@ -255,15 +498,30 @@ def delete_product(prod_id):
 @app.route('/sell/<int:prod_id>', methods=['POST'])
 def sell(prod_id):
     # ... (保持原有的 sell 代碼) ...
-    prod = Product.query.get_or_404(prod_id)
+    prod = Product.query.with_entities(Product.name, Product.price, Product.cost).filter_by(id=prod_id).first_or_404()
     qty = int(request.form['quantity'])
-    if prod.stock <= 0 or qty > prod.stock:
+    # 庫存檢查與扣減在同一個 UPDATE 內完成，同時下單也不會超賣
+    result = db.session.execute(
+        update(Product)
+        .where(Product.id == prod_id, Product.stock > 0, Product.stock >= qty)
+        .values(stock=Product.stock - qty)
+    )
+    if result.rowcount == 0:
         flash("已無庫存")
         return redirect(url_for('dashboard'))
-    prod.stock -= qty
     profit = (prod.price - prod.cost) * qty
     revenue = prod.price * qty
-    db.session.add(Sale(product_id=prod.id, quantity=qty, profit=profit, revenue=revenue))
+    db.session.execute(insert(Sale).values(product_id=prod_id, quantity=qty, profit=profit, revenue=revenue))
+    # 同一筆交易內累加當日該商品的彙總 (日期與 Sale.timestamp 同樣取 SQLite 本地時間)
+    db.session.execute(
+        sqlite_insert(DailyRollup)
+        .values(date=func.date('now', 'localtime'), product_id=prod_id, qty=qty, profit=profit, revenue=revenue)
+        .on_conflict_do_update(index_elements=['date', 'product_id'], set_={
+            'qty': DailyRollup.qty + qty,
+            'profit': DailyRollup.profit + profit,
+            'revenue': DailyRollup.revenue + revenue
+        })
+    )
     db.session.commit()
     flash(f"售出 {qty} 件 {prod.name}")
     return redirect(url_for('dashboard'))
@@ -271,24 +529,73 @@ def sell(prod_id):
 # [新功能] 手動導出月報表 (測試用)
 @app.route('/manual_monthly_export')
 def manual_monthly_export():
-    if not session.get('logged_in'): return redirect(url_for('login'))
     # 預設導出「本月」的，方便你現在立刻看到效果
     today = date.today()
-    filename = generate_monthly_html_report(today.year, today.month)
-    flash(f"月報表已保存 請查看 (檔案：{filename})")
+    filename = f"monthly_{today.year}_{today.month:02d}.html"
+    if queue_monthly_report(today.year, today.month):
+        flash(f"月報表產生中，稍後重新整理即可查看 (檔案：{filename})")
+    else:
+        flash(f"月報表已保存 請查看 (檔案：{filename})")
     return redirect(url_for('reports'))
 
 @app.route('/manual_export')
 def manual_export():
-    if not session.get('logged_in'): return redirect(url_for('login'))
     filename = generate_json_report(date.today())
     flash(f"今日數據已導出至 {filename}")
     return redirect(url_for('reports'))
 
+# /reports 的三組圖表：最近 7 個有銷售的日子、每月、本月各商品，UNION ALL 合成一次查詢
+# 三組數據都來自 daily_rollup (每天每商品一列)，不必掃整張 sale 表
+REPORT_STATS_SQL = text("""
+    SELECT 'daily' AS kind, label, total_profit, total_qty, total_revenue FROM (
+        SELECT date AS label, SUM(profit) AS total_profit, SUM(qty) AS total_qty, SUM(revenue) AS total_revenue
+        FROM daily_rollup GROUP BY date ORDER BY date DESC LIMIT 7
+    )
+    UNION ALL
+    SELECT 'monthly', strftime('%Y-%m', date), SUM(profit), SUM(qty), SUM(revenue)
+    FROM daily_rollup GROUP BY 2
+    UNION ALL
+    SELECT 'product', product.name, SUM(daily_rollup.profit), SUM(daily_rollup.qty), SUM(daily_rollup.revenue)
+    FROM daily_rollup JOIN product ON product.id = daily_rollup.product_id
+    WHERE daily_rollup.date >= :month_start GROUP BY product.name
+""").bindparams(bindparam('month_start', type_=db.Date))
+
+# 圖表數據只在有新銷售 (MAX(Sale.id) 改變) 或跨月時才需要重算，其餘請求直接沿用
+_charts_cache = {'key': None, 'payload': None}
+_charts_lock = threading.Lock()
+
+def get_chart_data():
+    today = date.today()
+    first_day_of_month = today.replace(day=1)
+    key = (db.session.query(func.max(Sale.id)).scalar(), first_day_of_month)
+    with _charts_lock:
+        if _charts_cache['key'] == key:
+            return _charts_cache['payload']
+
+    # 日 / 月 / 商品三組圖表數據一次查回，再依 kind 欄位分組
+    stats = {"daily": [], "monthly": [], "product": []}
+    for row in db.session.execute(REPORT_STATS_SQL, {'month_start': first_day_of_month}):
+        stats[row.kind].append(row)
+    # 日、月圖表由舊到新排列
+    stats["daily"].sort(key=lambda row: row.label)
+    stats["monthly"].sort(key=lambda row: row.label)
+
+    # 每組只走訪一次，同時填好四個序列
+    chart_data = {}
+    for kind, rows in stats.items():
+        series = chart_data[kind] = {"labels": [], "profit": [], "qty": [], "revenue": []}
+        for label, total_profit, total_qty, total_revenue in (row[1:] for row in rows):
+            series["labels"].append(str(label))
+            series["profit"].append(float(total_profit or 0))
+            series["qty"].append(int(total_qty or 0))
+            series["revenue"].append(float(total_revenue or 0))
+    with _charts_lock:
+        _charts_cache['key'] = key
+        _charts_cache['payload'] = chart_data
+    return chart_data
+
 @app.route('/reports')
 def reports():
-    if not session.get('logged_in'): return redirect(url_for('login'))
-    
     # ================= [新增] 掉單補救機制開始 =================
     # 邏輯：檢查「上個月」的報表檔案是否存在，如果不在就補做
     today = date.today()
@@ -302,94 +609,80 @@ def reports():
     
     # 拼湊出應該要有的檔名
     expected_filename = f"monthly_{target_year}_{target_month:02d}.html"
-    expected_path = os.path.join(app.config['RECORDS_FOLDER'], expected_filename)
     
-    # 檢查檔案是否存在
-    if not os.path.exists(expected_path):
+    # 檢查檔案是否存在 (直接查快取的歷史清單，不另外 stat)
+    # 已經排入背景、還在產生中的就不重複排
+    if expected_filename not in list_history_files() and not scheduler.get_job(monthly_report_job_id(target_year, target_month)):
         # 如果不存在，代表那天可能沒開機，現在立刻補做！
-        generate_monthly_html_report(target_year, target_month)
-        flash(f"系統偵測到「{target_month}月」報表尚未建立（可能因當時電腦未開機），已自動為您補齊！", "success")
+        if queue_monthly_report(target_year, target_month):
+            flash(f"系統偵測到「{target_month}月」報表尚未建立（可能因當時電腦未開機），已在背景為您補做，稍後重新整理即可查看！", "success")
+        else:
+            flash(f"系統偵測到「{target_month}月」報表尚未建立（可能因當時電腦未開機），已自動為您補齊！", "success")
     # ================= [新增] 掉單補救機制結束 =================
     # ... (保持原有的 reports 代碼) ...
-    if not session.get('logged_in'): return redirect(url_for('login'))
     two_days_ago = datetime.now() - timedelta(days=2)
-    recent_sales = Sale.query.filter(Sale.timestamp >= two_days_ago).order_by(Sale.timestamp.desc()).all()
+    recent_sales = Sale.query.options(joinedload(Sale.product)).filter(Sale.timestamp >= two_days_ago).order_by(Sale.timestamp.desc()).all()
     
-    daily_stats = db.session.query(
-        func.date(Sale.timestamp).label('d'), 
-        func.sum(Sale.profit).label('total_profit'),
-        func.sum(Sale.quantity).label('total_qty'),
-        func.sum(Sale.revenue).label('total_revenue')
-    ).group_by('d').order_by(func.date(Sale.timestamp).desc()).limit(7).all()
-    daily_stats = daily_stats[::-1]
-
-    d_labels = [str(row.d) for row in daily_stats]
-    d_profit = [float(row.total_profit or 0) for row in daily_stats]
-    d_qty = [int(row.total_qty or 0) for row in daily_stats]
-    d_revenue = [float(row.total_revenue or 0) for row in daily_stats]
-
-    monthly_stats = db.session.query(
-        func.strftime('%Y-%m', Sale.timestamp).label('m'), 
-        func.sum(Sale.profit).label('total_profit'),
-        func.sum(Sale.quantity).label('total_qty'),
-        func.sum(Sale.revenue).label('total_revenue')
-    ).group_by('m').order_by('m').all()
-
-    m_labels = [str(row.m) for row in monthly_stats]
-    m_profit = [float(row.total_profit or 0) for row in monthly_stats]
-    m_qty = [int(row.total_qty or 0) for row in monthly_stats]
-    m_revenue = [float(row.total_revenue or 0) for row in monthly_stats]
-
-    today = date.today()
-    first_day_of_month = datetime(today.year, today.month, 1)
-    product_stats = db.session.query(
-        Product.name,
-        func.sum(Sale.profit).label('total_profit'),
-        func.sum(Sale.quantity).label('total_qty'),
-        func.sum(Sale.revenue).label('total_revenue')
-    ).join(Sale).filter(Sale.timestamp >= first_day_of_month).group_by(Product.name).all()
-
-    p_labels = [row.name for row in product_stats]
-    p_profit = [float(row.total_profit or 0) for row in product_stats]
-    p_qty = [int(row.total_qty or 0) for row in product_stats]
-    p_revenue = [float(row.total_revenue or 0) for row in product_stats]
+    chart_data = get_chart_data()
     
-    history_files = []
-    if os.path.exists(app.config['RECORDS_FOLDER']):
-        history_files = sorted(os.listdir(app.config['RECORDS_FOLDER']), reverse=True)
+    history_files = list_history_files()
 
     return render_template('reports.html', 
                            recent_sales=recent_sales, 
                            history_files=history_files,
-                           chart_data={
-                               "daily": {"labels": d_labels, "profit": d_profit, "qty": d_qty, "revenue": d_revenue},
-                               "monthly": {"labels": m_labels, "profit": m_profit, "qty": m_qty, "revenue": m_revenue},
-                               "product": {"labels": p_labels, "profit": p_profit, "qty": p_qty, "revenue": p_revenue}
-                           })
+                           chart_data=chart_data)
 
 # [修改] 檢視報表功能：兼容 JSON 和 HTML
 @app.route('/view_report/<filename>')
 def view_report(filename):
-    if not session.get('logged_in'): return redirect(url_for('login'))
-    path = os.path.join(app.config['RECORDS_FOLDER'], filename)
+    # 如果是 HTML 檔案，直接傳送檔案 (瀏覽器會直接打開；檔案不存在時 send_from_directory 會回 404)
+    # conditional 傳送會帶 ETag / Last-Modified，瀏覽器重複檢視時直接拿到 304
+    # 當日 / 當月報表可能被手動重新導出，max_age=0 (no-cache) 讓瀏覽器每次都用 ETag 確認；報表需登入，只能存在瀏覽器端
+    if filename.endswith('.html'):
+        response = send_from_directory(app.config['RECORDS_FOLDER'], filename, conditional=True, etag=True, max_age=0)
+        response.cache_control.private = True
+        return response
     
-    if os.path.exists(path):
-        # 如果是 HTML 檔案，直接傳送檔案 (瀏覽器會直接打開)
-        if filename.endswith('.html'):
-            return send_from_directory(app.config['RECORDS_FOLDER'], filename)
-        
-        # 如果是 JSON 檔案，走原本的邏輯
-        elif filename.endswith('.json'):
-            with open(path, 'r', encoding='utf-8') as f: 
-                return render_template('report_detail.html', data=json.load(f))
+    # 如果是 JSON 檔案，優先送出產生報表時已渲染好的 HTML
+    elif filename.endswith('.json'):
+        try:
+            response = send_from_directory(app.config['RENDERED_FOLDER'], filename[:-len('.json')] + '.html', conditional=True, etag=True, max_age=0)
+            response.cache_control.private = True
+            return response
+        except NotFound:
+            pass
+        # 舊的報表沒有預先渲染的 HTML，直接開檔，不先另外檢查是否存在
+        try:
+            with open(os.path.join(app.config['RECORDS_FOLDER'], filename), 'rb') as f:
+                # 用檔案的修改時間 + 大小當 ETag，沒變就回 304，省下讀檔、解析與模板渲染
+                st = os.fstat(f.fileno())
+                etag = f"{st.st_mtime_ns:x}-{st.st_size:x}"
+                if etag in request.if_none_match:
+                    response = make_response("", 304)
+                else:
+                    response = make_response(render_template('report_detail.html', data=orjson.loads(f.read())))
+        except FileNotFoundError:
+            return "File not found", 404
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
                 
     return "File not found", 404
 
+# 原始報表檔下載 (JSON / HTML)，與檢視報表相同：只允許瀏覽器快取，每次以 ETag 確認是否重新導出過
+@app.route('/records/<filename>')
+def download_record(filename):
+    response = send_from_directory(app.config['RECORDS_FOLDER'], filename, conditional=True, max_age=0)
+    response.cache_control.private = True
+    return response
+
 # ... (login, logout, main 保持不變) ...
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
-        if User.query.filter_by(username=request.form['username'], password=request.form['password']).first():
+        user = User.query.filter_by(username=request.form['username']).first()
+        if user and check_password_hash(user.password, request.form['password']):
             session['logged_in'] = True
             return redirect(url_for('dashboard'))
         flash("錯誤")
@@ -403,24 +696,66 @@ def logout():
 #TEST
 @app.route('/debug/simulate_month_end')
 def debug_simulate_month_end():
-    if not session.get('logged_in'): return redirect(url_for('login'))
-    
     # 取得「今天」所在的年、月
     today = date.today()
     
     # 強制執行生成報表邏輯
     # 這會把 "這個月 1號" 到 "今天這一刻" 的所有資料，視為一個完整的月報表
-    filename = generate_monthly_html_report(today.year, today.month)
-    
-    flash(f"🔴【測試成功】已強制模擬本月結算！報表已生成：{filename}")
+    filename = f"monthly_{today.year}_{today.month:02d}.html"
+    if queue_monthly_report(today.year, today.month):
+        flash(f"🔴【測試成功】已強制模擬本月結算！報表產生中：{filename}")
+    else:
+        flash(f"🔴【測試成功】已強制模擬本月結算！報表已生成：{filename}")
     return redirect(url_for('reports'))
 
+# 舊資料庫的 sale.timestamp 沒有資料庫端預設值；SQLite 無法 ALTER 欄位預設值，只能重建資料表
+def migrate_sale_timestamp_default():
+    with db.engine.begin() as conn:
+        columns = {row[1]: row[4] for row in conn.execute(text("PRAGMA table_info(sale)"))}
+        if columns.get('timestamp') is not None: return
+        conn.execute(text("ALTER TABLE sale RENAME TO sale_old"))
+        for index in Sale.__table__.indexes: conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+        Sale.__table__.create(conn)
+        conn.execute(text("INSERT INTO sale (id, product_id, quantity, profit, revenue, timestamp) "
+                          "SELECT id, product_id, quantity, profit, revenue, timestamp FROM sale_old"))
+        conn.execute(text("DROP TABLE sale_old"))
+
+# daily_rollup 剛建立 (或被清空) 時，從既有的銷售紀錄一次補齊
+def backfill_daily_rollup():
+    if DailyRollup.query.first(): return
+    db.session.execute(text(
+        "INSERT INTO daily_rollup (date, product_id, qty, profit, revenue) "
+        "SELECT date(timestamp), product_id, SUM(quantity), SUM(profit), SUM(COALESCE(revenue, 0)) "
+        "FROM sale GROUP BY date(timestamp), product_id"
+    ))
+    db.session.commit()
+
+# 啟動時建表、搬移舊資料；多個 worker 同時載入模組時以檔案鎖排隊，一次只有一個行程在改資料庫結構
+def init_database():
+    lock_file = acquire_file_lock('init.lock')
+    try:
+        with app.app_context():
+            db.create_all()
+            migrate_sale_timestamp_default()
+            backfill_daily_rollup()
+            # create_all 不會替既有資料表補建索引，舊資料庫在這裡補上
+            for model in (Product, Sale):
+                for index in model.__table__.indexes: index.create(db.engine, checkfirst=True)
+            if not User.query.first(): db.session.add(User(username='admin', password=generate_password_hash('123'))) 
+            # 舊資料庫的明碼密碼轉成雜湊；werkzeug 雜湊一定以演算法名稱開頭 (scrypt:... / pbkdf2:...)，明碼本身可能含有 $
+            for user in User.query.all():
+                if not user.password.startswith(PASSWORD_HASH_PREFIXES): user.password = generate_password_hash(user.password)
+            if not Category.query.first(): db.session.add(Category(name='一般商品'))
+            db.session.commit()
+    finally:
+        if lock_file: lock_file.close()
+
+# 模組載入時就建表、搬移資料，python app.py、flask 指令與 gunicorn 的 worker 都會執行到這裡 (排程器不在這裡啟動)
+init_database()
+
 if __name__ == '__main__':
-    with app.app_context():
-        db.create_all()
-        if not User.query.first(): db.session.add(User(username='admin', password='123')) 
-        if not Category.query.first(): db.session.add(Category(name='一般商品'))
-        db.session.commit()
-    scheduler.init_app(app)
-    scheduler.start()
-    app.run(debug=True)
\ No newline at end of file
+    # 以 python app.py 執行時模組名稱是 __main__，登記成 app，排程工作的 'app:...' 參照才會指向同一個模組
+    sys.modules.setdefault('app', sys.modules[__name__])
+    start_scheduler()
+    # 開發時以 FLASK_DEBUG=1 啟動除錯模式
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1')
\ No newline at end of file
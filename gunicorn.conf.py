@@ -0,0 +1,6 @@
+# gunicorn 預設會讀取這個檔案：gunicorn app:app
+
+# worker 匯入 app 模組完成後才啟動排程器 (只有搶到排程鎖的 worker 會真的啟動)
+def post_worker_init(worker):
+    from app import start_scheduler
+    start_scheduler()
@@ -0,0 +1,54 @@
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 在暫存資料夾裡以子行程執行 app，逾時代表啟動卡死
+def run_app(cwd, code, timeout=30):
+    return subprocess.run([sys.executable, '-c', code], cwd=cwd, timeout=timeout, capture_output=True, text=True)
+
+START_AND_WAIT = """
+import time, app
+assert app.start_scheduler()
+deadline = time.time() + 20
+while time.time() < deadline and not all(os.path.exists(f) for f in EXPECTED):
+    time.sleep(0.2)
+app.scheduler.shutdown()
+"""
+
+class CatchUpDailyReportsTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = tempfile.mkdtemp()
+        shutil.copy(os.path.join(ROOT, 'app.py'), self.cwd)
+        shutil.copytree(os.path.join(ROOT, 'templates'), os.path.join(self.cwd, 'templates'))
+
+    def tearDown(self):
+        shutil.rmtree(self.cwd, ignore_errors=True)
+
+    # 重新啟動時補做多天漏掉的日報表：匯入要能返回，報表要真的產生
+    def test_restart_with_missing_daily_reports(self):
+        first = run_app(self.cwd, "import app\nassert app.start_scheduler()\napp.scheduler.shutdown()")
+        self.assertEqual(first.returncode, 0, first.stderr)
+
+        days = [date.today() - timedelta(days=n) for n in (2, 3)]
+        conn = sqlite3.connect(os.path.join(self.cwd, 'instance', 'database.db'))
+        conn.execute("INSERT INTO product (name, image, cost, price, stock, category_id, is_deleted) VALUES ('p', 'default.jpg', 1, 2, 10, 1, 0)")
+        for day in days:
+            conn.execute("INSERT INTO sale (product_id, quantity, profit, revenue, timestamp) VALUES (1, 1, 1, 2, ?)", (f"{day.isoformat()} 10:00:00.000000",))
+        conn.commit()
+        conn.close()
+
+        expected = [os.path.join('static', 'records', f"daily_{day.year}{day.month:02d}{day.day:02d}.json") for day in days]
+        second = run_app(self.cwd, f"import os\nEXPECTED = {expected!r}" + START_AND_WAIT)
+        self.assertEqual(second.returncode, 0, second.stderr)
+        for path in expected:
+            self.assertTrue(os.path.exists(os.path.join(self.cwd, path)), path)
+
+if __name__ == '__main__':
+    unittest.main()